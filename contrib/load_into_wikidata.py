@@ -1,22 +1,53 @@
 #!/usr/bin/env python3
 import argparse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import io
 import json
+import os
 import re
-from typing import NamedTuple, Optional
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+from typing import Any, BinaryIO, Iterator, Match, NamedTuple, Optional
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 PROPERTY_LOCATED_IN_TIME_ZONE = "P421"
 USER_AGENT = "AirfieldTimezones (https://github.com/RavuAlHemio/airfield-timezones)"
-ENTITY_RE = re.compile("^Q(?P<numeric>[0-9]+)$")
+# wbeditentity payload adding a located-in-time-zone statement; only the
+# numeric ID of the timezone item varies, so skip building and serializing it
+TIMEZONE_CLAIM_DATA_TEMPLATE = (
+    '{"claims":[{"mainsnak":{"snaktype":"value","property":"' + PROPERTY_LOCATED_IN_TIME_ZONE + '",'
+    '"datavalue":{"value":{"entity-type":"item","numeric-id":%d},"type":"wikibase-entityid"}},'
+    '"type":"statement","rank":"normal"}]}'
+)
+# escape sequences that may appear in literals of SPARQL TSV results (as in Turtle)
+SPARQL_TSV_ESCAPE_RE = re.compile(r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))")
+SPARQL_TSV_ESCAPES = {
+    "t": "\t",
+    "b": "\b",
+    "n": "\n",
+    "r": "\r",
+    "f": "\f",
+}
 
 
-class Airport(NamedTuple):
-    entity: str
-    icao: str
-    name: str
-    timezone_entity: Optional[str]
-    timezone_name: Optional[str]
+class Airports(NamedTuple):
+    # column-wise to avoid a per-airport object; keyed by ICAO code
+    entity_by_icao: dict[str, str]
+    # only contains airports for which Wikibase already knows the timezone
+    timezone_entity_by_icao: dict[str, str]
 
 
 def get_oauth_token(oauth_json_file: str) -> str:
@@ -25,92 +56,332 @@ def get_oauth_token(oauth_json_file: str) -> str:
     return j["access_token"]
 
 
-def get_iana_timezone_to_wikidata(
-    iana_timezone_query: str,
+def json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def make_session(max_connections_per_host: int) -> requests.Session:
+    session = requests.Session()
+    session.headers.update({
+        "User-Agent": USER_AGENT,
+    })
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        # keep one connection alive per concurrent request so none of them is discarded and reopened
+        pool_maxsize=max_connections_per_host,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def encode_sparql_query(query: str) -> bytes:
+    # the queries never change during a run; form-encode them once up front
+    return urlencode({"query": query}).encode("utf-8")
+
+
+@contextmanager
+def post_sparql_query(
+    session: requests.Session,
+    query_body: bytes,
     sparql_endpoint: str,
-    entity_prefix: str,
-) -> dict[str, str]:
+) -> Iterator[BinaryIO]:
+    with session.post(
+        sparql_endpoint,
+        data=query_body,
+        headers={
+            "Content-Type": "application/x-www-form-urlencoded",
+            # two-column results are far smaller and cheaper to parse as TSV than as JSON
+            "Accept": "text/tab-separated-values",
+        },
+        stream=True,
+    ) as response:
+        response.raise_for_status()
+        # transparently undo any Content-Encoding while streaming
+        response.raw.decode_content = True
+        # TextIOWrapper still reads its buffered lines after the body has been consumed;
+        # urllib3 would otherwise report the stream as closed at that point
+        response.raw.auto_close = False
+        yield response.raw
+
+
+def get_cached_sparql_results(
+    session: requests.Session,
+    query_body: bytes,
+    sparql_endpoint: str,
+    cache_dir: str,
+    cache_max_age: float,
+) -> str:
+    # results from a different endpoint (e.g. a test Wikibase) must never be reused
+    query_hash = hashlib.sha256(sparql_endpoint.encode("utf-8") + b"\0" + query_body).hexdigest()
+    path = os.path.join(cache_dir, f"{query_hash}.tsv")
+    try:
+        if time.time() - os.path.getmtime(path) < cache_max_age:
+            return path
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with post_sparql_query(session, query_body, sparql_endpoint) as results:
+        temp_fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(temp_fd, "wb") as f:
+                shutil.copyfileobj(results, f)
+            # only ever expose complete results under the final name
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    return path
+
+
+@contextmanager
+def sparql_results(
+    session: requests.Session,
+    query_body: bytes,
+    sparql_endpoint: str,
+    dump_name: str,
+    cache_dir: Optional[str],
+    cache_max_age: float,
+) -> Iterator[BinaryIO]:
     if sparql_endpoint.startswith("file://"):
-        path = sparql_endpoint.removeprefix("file://") + "wikidata_iana_timezone.json"
-        with open(path, "r", encoding="utf-8") as f:
-            json_doc = json.load(f)
+        path = sparql_endpoint.removeprefix("file://") + f"{dump_name}.tsv"
+    elif cache_dir is not None:
+        path = get_cached_sparql_results(session, query_body, sparql_endpoint, cache_dir, cache_max_age)
     else:
-        timezones_response = requests.post(
-            sparql_endpoint,
-            data={
-                "query": iana_timezone_query,
-                "format": "json",
-            },
-            headers={
-                "User-Agent": USER_AGENT,
-            },
-        )
-        timezones_response.raise_for_status()
-        json_doc = timezones_response.json()
+        with post_sparql_query(session, query_body, sparql_endpoint) as results:
+            yield results
+        return
+
+    with open(path, "rb") as f:
+        yield f
 
+
+def unescape_sparql_tsv_match(match: Match[str]) -> str:
+    short_hex, long_hex, escaped_char = match.groups()
+    if escaped_char is None:
+        return chr(int(short_hex or long_hex, 16))
+    return SPARQL_TSV_ESCAPES.get(escaped_char, escaped_char)
+
+
+def parse_sparql_tsv_term(term: str) -> Optional[str]:
+    if term == "":
+        # unbound variable
+        return None
+    if term.startswith("<") and term.endswith(">"):
+        return term[1:-1]
+    if term.startswith('"'):
+        # strip the quotes along with any language tag or datatype
+        value = term[1:term.rindex('"')]
+        if "\\" in value:
+            value = SPARQL_TSV_ESCAPE_RE.sub(unescape_sparql_tsv_match, value)
+        return value
+    # numbers, booleans and blank nodes are written bare
+    return term
+
+
+def iter_sparql_rows(results: BinaryIO) -> Iterator[dict[str, Optional[str]]]:
+    lines = io.TextIOWrapper(results, encoding="utf-8", newline="\n")
+    header = next(lines, None)
+    if header is None:
+        return
+    variables = [variable.removeprefix("?") for variable in header.rstrip("\r\n").split("\t")]
+    for line in lines:
+        terms = line.rstrip("\r\n").split("\t")
+        yield {
+            variable: parse_sparql_tsv_term(term)
+            for variable, term in zip(variables, terms)
+        }
+
+
+def get_iana_timezone_to_wikidata(
+    session: requests.Session,
+    iana_timezone_query_body: bytes,
+    sparql_endpoint: str,
+    entity_prefix: str,
+    cache_dir: Optional[str],
+    cache_max_age: float,
+) -> dict[str, str]:
     iana_timezone_to_wikidata: dict[str, str] = {}
-    for binding in json_doc["results"]["bindings"]:
-        wikidata_item = binding["timezone"]["value"].removeprefix(entity_prefix)
-        iana_timezone = binding["zoneName"]["value"]
-        iana_timezone_to_wikidata[iana_timezone] = wikidata_item
+    with sparql_results(
+        session,
+        iana_timezone_query_body,
+        sparql_endpoint,
+        "wikidata_iana_timezone",
+        cache_dir,
+        cache_max_age,
+    ) as results:
+        entity_prefix_len = len(entity_prefix)
+        for row in iter_sparql_rows(results):
+            wikidata_item = row["timezone"]
+            if wikidata_item.startswith(entity_prefix):
+                wikidata_item = wikidata_item[entity_prefix_len:]
+            iana_timezone = row["zoneName"]
+            iana_timezone_to_wikidata[iana_timezone] = wikidata_item
     return iana_timezone_to_wikidata
 
 
 def get_icao_to_airport(
-    airport_icao_query: str,
+    session: requests.Session,
+    airport_icao_query_body: bytes,
     sparql_endpoint: str,
     entity_prefix: str,
-) -> dict[str, Airport]:
-    if sparql_endpoint.startswith("file://"):
-        path = sparql_endpoint.removeprefix("file://") + "wikidata_airport_icao.json"
-        with open(path, "r", encoding="utf-8") as f:
-            json_doc = json.load(f)
-    else:
-        airports_response = requests.post(
-            sparql_endpoint,
-            data={
-                "query": airport_icao_query,
-                "format": "json",
-            },
-            headers={
-                "User-Agent": USER_AGENT,
-            },
-        )
-        airports_response.raise_for_status()
-        json_doc = airports_response.json()
+    cache_dir: Optional[str],
+    cache_max_age: float,
+) -> Airports:
+    entity_by_icao: dict[str, str] = {}
+    timezone_entity_by_icao: dict[str, str] = {}
+    with sparql_results(
+        session,
+        airport_icao_query_body,
+        sparql_endpoint,
+        "wikidata_airport_icao",
+        cache_dir,
+        cache_max_age,
+    ) as results:
+        entity_prefix_len = len(entity_prefix)
+        for row in iter_sparql_rows(results):
+            icao_code = row["icaoCode"]
+            if icao_code in entity_by_icao:
+                continue
+            entity = row["airport"]
+            if entity.startswith(entity_prefix):
+                entity = entity[entity_prefix_len:]
+            entity_by_icao[icao_code] = entity
+            timezone_entity = row["timezone"]
+            if timezone_entity is not None:
+                if timezone_entity.startswith(entity_prefix):
+                    timezone_entity = timezone_entity[entity_prefix_len:]
+                timezone_entity_by_icao[icao_code] = timezone_entity
+    return Airports(
+        entity_by_icao=entity_by_icao,
+        timezone_entity_by_icao=timezone_entity_by_icao,
+    )
 
-    icao_to_airport: dict[str, Airport] = {}
-    for binding in json_doc["results"]["bindings"]:
-        icao_code = binding["icaoCode"]["value"]
-        if icao_code in icao_to_airport:
-            continue
-        entity = binding["airport"]["value"].removeprefix(entity_prefix)
-        name = binding["airportLabel"]["value"]
-        timezone_entity = binding.get("timezone", {}).get("value", None)
-        if timezone_entity is not None:
-            timezone_entity = timezone_entity.removeprefix(entity_prefix)
-        timezone_name = binding.get("zoneName", {}).get("value", None)
-        icao_to_airport[icao_code] = Airport(
-            entity=entity,
-            icao=icao_code,
-            name=name,
-            timezone_entity=timezone_entity,
-            timezone_name=timezone_name,
-        )
-    return icao_to_airport
+
+def get_csrf_token(
+    session: requests.Session,
+    api_endpoint: str,
+    bearer_token: str,
+) -> str:
+    csrf_token_response = session.get(
+        api_endpoint,
+        params={
+            "format": "json",
+            "action": "query",
+            "meta": "tokens",
+            "type": "csrf",
+        },
+        headers={
+            "Authorization": bearer_token,
+        },
+    )
+    csrf_token_response.raise_for_status()
+    return json_loads(csrf_token_response.content)["query"]["tokens"]["csrftoken"]
+
+
+class CsrfToken:
+    # shared between the claim-submitting threads; only refetched once Wikibase rejects it
+    def __init__(self, session: requests.Session, api_endpoint: str, bearer_token: str):
+        self.session = session
+        self.api_endpoint = api_endpoint
+        self.bearer_token = bearer_token
+        self.token = get_csrf_token(session, api_endpoint, bearer_token)
+        self.lock = threading.Lock()
+
+    def refresh(self, stale_token: str) -> str:
+        with self.lock:
+            # another thread might have already replaced the stale token
+            if self.token == stale_token:
+                self.token = get_csrf_token(self.session, self.api_endpoint, self.bearer_token)
+            return self.token
+
+
+def get_api_error_code(response: requests.Response) -> Optional[str]:
+    try:
+        json_doc = json_loads(response.content)
+    except ValueError:
+        return None
+    if not isinstance(json_doc, dict):
+        return None
+    return json_doc.get("error", {}).get("code", None)
+
+
+def post_timezone_claim(
+    session: requests.Session,
+    api_endpoint: str,
+    bearer_token: str,
+    token: str,
+    entity: str,
+    timezone_entity_id: int,
+) -> requests.Response:
+    return session.post(
+        api_endpoint,
+        params={
+            "format": "json",
+            "action": "wbeditentity",
+            "id": entity,
+        },
+        data={
+            "data": TIMEZONE_CLAIM_DATA_TEMPLATE % timezone_entity_id,
+            "token": token,
+        },
+        headers={
+            "Authorization": bearer_token,
+        },
+    )
+
+
+def submit_timezone_claim(
+    session: requests.Session,
+    api_endpoint: str,
+    bearer_token: str,
+    csrf_token: CsrfToken,
+    entity: str,
+    timezone_entity_id: int,
+) -> requests.Response:
+    token = csrf_token.token
+    claim_response = post_timezone_claim(session, api_endpoint, bearer_token, token, entity, timezone_entity_id)
+    if get_api_error_code(claim_response) == "badtoken":
+        # the token has expired; fetch a new one and retry once
+        token = csrf_token.refresh(token)
+        claim_response = post_timezone_claim(session, api_endpoint, bearer_token, token, entity, timezone_entity_id)
+    return claim_response
+
+
+def print_claim_response(claim_response: requests.Response):
+    print(claim_response.status_code)
+    print(claim_response.text)
+
+
+def get_timezone_entity_id(iana_timezone_to_wikidata: dict[str, str], timezone: str) -> int:
+    timezone_entity = iana_timezone_to_wikidata.get(timezone, None)
+    if timezone_entity is None:
+        raise ValueError(f"IANA timezone {timezone!r} unknown to Wikibase")
+    timezone_entity_numeric = timezone_entity[1:]
+    if not (timezone_entity.startswith("Q") and timezone_entity_numeric.isascii() and timezone_entity_numeric.isdigit()):
+        raise ValueError(f"timezone entity {timezone_entity!r} is invalid")
+    return int(timezone_entity_numeric)
 
 
 def get_icao_to_timezone(filename: str) -> dict[str, str]:
+    with open(filename, "rb") as f:
+        data = f.read()
     icao_to_timezone: dict[str, str] = {}
-    with open(filename, "r", encoding="utf-8") as f:
-        for raw_ln in f:
-            ln = raw_ln.rstrip("\r\n")
-            pieces = ln.split(" ", 1)
-            if len(pieces) != 2:
-                continue
-            if pieces[1] == "?":
-                continue
-            icao_to_timezone[pieces[0]] = pieces[1]
+    for raw_ln in data.splitlines():
+        icao, sep, timezone = raw_ln.partition(b" ")
+        if not sep:
+            continue
+        if timezone == b"?":
+            continue
+        icao_to_timezone[icao.decode("utf-8")] = timezone.decode("utf-8")
     return icao_to_timezone
 
 
@@ -143,6 +414,16 @@ def main():
         dest="airport_icao_query", default="wikidata_airport_icao.sparql",
         help="File containing query to obtain the items that define airports."
     )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir", metavar="DIR", default=None,
+        help="Directory in which to cache SPARQL query results."
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        dest="cache_max_age", metavar="HOURS", type=float, default=24.0,
+        help="Maximum age of cached SPARQL query results to reuse."
+    )
     parser.add_argument(
         "--oauth-config",
         dest="oauth_config", metavar="OAUTH.JSON", default="wikidata_oauth.json",
@@ -158,6 +439,11 @@ def main():
         dest="yes_all_airports", action="store_true",
         help="Whether to actually import all airports."
     )
+    parser.add_argument(
+        "--parallel-edits",
+        dest="parallel_edits", metavar="COUNT", type=int, default=1,
+        help="Number of claim edits to submit to the Wikibase API concurrently."
+    )
     parser.add_argument(
         dest="icao_to_timezone", metavar="ICAO_TO_TIMEZONE",
         help="File containing mappings of ICAO airport codes to IANA timezones.",
@@ -167,84 +453,101 @@ def main():
         raise ValueError("either '--airport ICAO' or '--yes-all-airports' must be passed")
     if args.airport is not None and args.yes_all_airports:
         raise ValueError("'--airport ICAO' and '--yes-all-airports' may not be passed simultaneously")
+    if args.parallel_edits < 1:
+        raise ValueError("'--parallel-edits' must be at least 1")
 
     with open(args.iana_timezone_query, "r", encoding="utf-8") as f:
-        iana_timezone_query = f.read()
+        iana_timezone_query_body = encode_sparql_query(f.read())
     with open(args.airport_icao_query, "r", encoding="utf-8") as f:
-        airport_icao_query = f.read()
+        airport_icao_query_body = encode_sparql_query(f.read())
     oauth_token = get_oauth_token(args.oauth_config)
 
-    iana_timezone_to_wikidata = get_iana_timezone_to_wikidata(
-        iana_timezone_query,
-        args.sparql_endpoint,
-        args.entity_prefix,
-    )
-    icao_to_airport = get_icao_to_airport(
-        airport_icao_query,
-        args.sparql_endpoint,
-        args.entity_prefix,
-    )
-    icao_to_timezone = get_icao_to_timezone(args.icao_to_timezone)
-
-    bearer_token = f"Bearer {oauth_token}"
-    for _icao, airport in sorted(icao_to_airport.items()):
-        if airport.icao != args.airport and not args.yes_all_airports:
-            continue
+    # pool one connection per concurrent request (at least the two SPARQL queries)
+    session = make_session(max(2, args.parallel_edits))
+    cache_max_age = args.cache_max_age * 60 * 60
+    # the two queries are independent; run them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        iana_timezone_to_wikidata_future = executor.submit(
+            get_iana_timezone_to_wikidata,
+            session,
+            iana_timezone_query_body,
+            args.sparql_endpoint,
+            args.entity_prefix,
+            args.cache_dir,
+            cache_max_age,
+        )
+        airports_future = executor.submit(
+            get_icao_to_airport,
+            session,
+            airport_icao_query_body,
+            args.sparql_endpoint,
+            args.entity_prefix,
+            args.cache_dir,
+            cache_max_age,
+        )
+        icao_to_timezone = get_icao_to_timezone(args.icao_to_timezone)
+        iana_timezone_to_wikidata = iana_timezone_to_wikidata_future.result()
+        airports = airports_future.result()
 
-        if airport.timezone_entity is not None:
+    if args.yes_all_airports:
+        candidate_icaos = list(airports.entity_by_icao)
+    elif args.airport in airports.entity_by_icao:
+        candidate_icaos = [args.airport]
+    else:
+        candidate_icaos = []
+    # filter down to the airports whose timezone we know but Wikibase doesn't,
+    # resolving each distinct timezone only once however many airports share it
+    timezone_entity_ids: dict[str, int] = {}
+    pending_claims: list[tuple[str, str, int]] = []
+    for icao in candidate_icaos:
+        if icao in airports.timezone_entity_by_icao:
             # we already know the timezone
             continue
-        timezone = icao_to_timezone.get(airport.icao, None)
+        timezone = icao_to_timezone.get(icao, None)
         if timezone is None:
             # we don't know the timezone
             continue
-        timezone_entity = iana_timezone_to_wikidata.get(timezone, None)
-        if timezone_entity is None:
-            raise ValueError(f"IANA timezone {timezone!r} unknown to Wikibase")
-        timezone_entity_match = ENTITY_RE.search(timezone_entity)
-        if timezone_entity_match is None:
-            raise ValueError(f"timezone entity {timezone_entity!r} is invalid")
-        timezone_entity_id = int(timezone_entity_match.group("numeric"))
-
-        csrf_token_response = requests.get(
-            args.api_endpoint,
-            params={
-                "format": "json",
-                "action": "query",
-                "meta": "tokens",
-                "type": "csrf",
-            },
-            headers={
-                "User-Agent": USER_AGENT,
-                "Authorization": bearer_token,
-            },
-        )
-        csrf_token_response.raise_for_status()
-        csrf_token = csrf_token_response.json()["query"]["tokens"]["csrftoken"]
-
-        claim_response = requests.post(
-            args.api_endpoint,
-            params={
-                "format": "json",
-                "action": "wbcreateclaim",
-                "entity": airport.entity,
-                "property": PROPERTY_LOCATED_IN_TIME_ZONE,
-                "snaktype": "value",
-                "value": json.dumps({
-                    "entity-type": "item",
-                    "numeric-id": timezone_entity_id,
-                }),
-            },
-            data={
-                "token": csrf_token,
-            },
-            headers={
-                "User-Agent": USER_AGENT,
-                "Authorization": bearer_token,
-            },
-        )
-        print(claim_response.status_code)
-        print(claim_response.text)
+        timezone_entity_id = timezone_entity_ids.get(timezone, None)
+        if timezone_entity_id is None:
+            timezone_entity_id = get_timezone_entity_id(iana_timezone_to_wikidata, timezone)
+            timezone_entity_ids[timezone] = timezone_entity_id
+        pending_claims.append((icao, airports.entity_by_icao[icao], timezone_entity_id))
+    pending_claims.sort()
+    if not pending_claims:
+        # nothing to edit; don't bother the API
+        return
+
+    bearer_token = f"Bearer {oauth_token}"
+    # CSRF tokens remain valid for the whole session; fetch one up front
+    csrf_token = CsrfToken(session, args.api_endpoint, bearer_token)
+    with ThreadPoolExecutor(max_workers=args.parallel_edits) as executor:
+        # only keep as many edits in flight as there are workers so that a failure
+        # stops the run instead of the executor working through the rest of the queue
+        claim_futures: deque[Future[requests.Response]] = deque()
+        try:
+            for _icao, entity, timezone_entity_id in pending_claims:
+                if len(claim_futures) >= args.parallel_edits:
+                    print_claim_response(claim_futures.popleft().result())
+                claim_futures.append(executor.submit(
+                    submit_timezone_claim,
+                    session,
+                    args.api_endpoint,
+                    bearer_token,
+                    csrf_token,
+                    entity,
+                    timezone_entity_id,
+                ))
+            while claim_futures:
+                print_claim_response(claim_futures.popleft().result())
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            # edits that were already running still reach Wikibase; log them before giving up
+            for claim_future in claim_futures:
+                try:
+                    print_claim_response(claim_future.result())
+                except Exception as exc:
+                    print(f"{type(exc).__name__}: {exc}")
+            raise
 
 
 if __name__ == "__main__":